@@ -0,0 +1,278 @@
+# Chat history search shared by the MCP server entrypoints: request/response
+# schemas, SQL for each search mode, and snippet extraction. Servers only add
+# their own auth and HTTP plumbing on top of run_chat_query/stream_chat_query.
+from pydantic import BaseModel
+import asyncpg
+import itertools
+import re
+from typing import Optional, List, AsyncIterator
+from datetime import datetime
+
+# Result count used when a query does not set one, and the most a query may ask for
+DEFAULT_LIMIT = 10
+MAX_LIMIT = 500
+
+# Input schema for MCP search
+class ChatHistoryQuery(BaseModel):
+    search_term: str
+    author_role: Optional[str] = None
+    conversation_title: Optional[str] = None
+    limit: Optional[int] = DEFAULT_LIMIT
+    context_radius: Optional[int] = 2500
+    # Match only messages that start with search_term (case-insensitive)
+    prefix: Optional[bool] = False
+
+# Output schema
+class ChatEntry(BaseModel):
+    timestamp: datetime
+    author: str
+    title: Optional[str]
+    content: str
+    truncated: Optional[bool] = False
+
+# Search strategies, see search_mode()
+SEARCH_FTS = "fts"
+SEARCH_ILIKE = "ilike"
+SEARCH_PREFIX = "prefix"
+SEARCH_LONG_PREFIX = "long_prefix"
+
+# messages.content_lc holds lower(left(content, N)) so it fits in a btree entry
+CONTENT_LC_LENGTH = 255
+
+# Multi-word terms without LIKE wildcards are searched as natural language
+# (full-text, ranked); everything else keeps the substring ILIKE search
+def is_phrase_search(search_term: str) -> bool:
+    term = search_term.strip()
+    return any(ch.isspace() for ch in term) and "%" not in term and "_" not in term
+
+# Prefix searches run as a btree range scan on content_lc. A term longer than the
+# indexed column narrows by its first CONTENT_LC_LENGTH characters and checks the
+# rest against the full content. Full-text and substring ILIKE cover everything else
+def search_mode(query: ChatHistoryQuery) -> str:
+    if query.prefix:
+        if len(query.search_term) <= CONTENT_LC_LENGTH:
+            return SEARCH_PREFIX
+        return SEARCH_LONG_PREFIX
+    if is_phrase_search(query.search_term):
+        return SEARCH_FTS
+    return SEARCH_ILIKE
+
+# Escape LIKE wildcards so the term is matched literally
+def like_escape(term: str) -> str:
+    return term.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+# ts_headline works in words; roughly 6 characters per word keeps full-text
+# snippets close to the requested context_radius
+def headline_options(context_radius: int) -> str:
+    max_words = max(context_radius // 6, 2)
+    min_words = max(max_words // 2, 1)
+    return (
+        f"MaxWords={max_words}, MinWords={min_words}, ShortWord=3, "
+        f'HighlightAll=false, StartSel="", StopSel=""'
+    )
+
+# Assemble the search SQL for one combination of search mode and optional filters.
+# Placeholders are numbered in the order query_params() emits its values.
+def build_sql(mode: str, has_role: bool, has_title: bool) -> str:
+    n = 1
+    if mode == SEARCH_FTS:
+        tsquery = f"plainto_tsquery('english', ${n})"
+        conditions = [f"m.content_tsv @@ {tsquery}", "m.author_role != 'tool'"]
+        order_by = f"ts_rank_cd(m.content_tsv, {tsquery}) DESC, m.timestamp DESC"
+
+        # Let Postgres cut long messages down to a snippet around the match
+        # so only ~context_radius characters per row cross the wire
+        radius, options = f"${n + 1}", f"${n + 2}"
+        columns = (
+            f"CASE WHEN length(m.content) <= {radius} THEN m.content"
+            f" ELSE ts_headline('english', m.content, {tsquery}, {options}) END,"
+            f" length(m.content) > {radius}"
+        )
+        n += 3
+    elif mode == SEARCH_PREFIX:
+        # Lowercase the pattern in SQL so it folds exactly like the stored column
+        # (lower() follows the database collation); lower() of a bound constant is
+        # folded at plan time, so the index range scan still applies
+        conditions = [f"m.content_lc LIKE lower(${n})", "m.author_role != 'tool'"]
+        order_by = "m.timestamp DESC"
+        columns = "m.content"
+        n += 1
+    elif mode == SEARCH_LONG_PREFIX:
+        conditions = [
+            f"m.content_lc LIKE lower(${n})",
+            f"lower(m.content) LIKE lower(${n + 1})",
+            "m.author_role != 'tool'",
+        ]
+        order_by = "m.timestamp DESC"
+        columns = "m.content"
+        n += 2
+    else:
+        conditions = [f"m.content ILIKE ${n}", "m.author_role != 'tool'"]
+        order_by = "m.timestamp DESC"
+        columns = "m.content"
+        n += 1
+
+    if has_role:
+        conditions.append(f"m.author_role = ${n}")
+        n += 1
+
+    if has_title:
+        conditions.append(f"c.title ILIKE ${n}")
+        n += 1
+
+    return f"""
+        SELECT m.timestamp, m.author_role, c.title, {columns}
+        FROM messages m
+        JOIN conversations c ON m.conversation_id = c.id
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {order_by}
+        LIMIT {{limit}}
+    """
+
+# Every statement shape the endpoint can issue, built once at import time and keyed
+# by (mode, has_role, has_title). The LIMIT is filled in by search_sql().
+SQL_VARIANTS = {
+    key: build_sql(*key)
+    for key in itertools.product(
+        (SEARCH_FTS, SEARCH_ILIKE, SEARCH_PREFIX, SEARCH_LONG_PREFIX),
+        (False, True),
+        (False, True),
+    )
+}
+
+# Requested result count, defaulted and clamped to 1..MAX_LIMIT
+def clamp_limit(limit: Optional[int]) -> int:
+    if limit is None:
+        limit = DEFAULT_LIMIT
+    return min(max(int(limit), 1), MAX_LIMIT)
+
+# The LIMIT is inlined as a literal rather than bound, so Postgres plans knowing
+# how few rows are wanted (e.g. an ordered index scan that stops early). `limit`
+# must come from clamp_limit()
+def search_sql(mode: str, has_role: bool, has_title: bool, limit: int) -> str:
+    return SQL_VARIANTS[(mode, has_role, has_title)].format(limit=limit)
+
+# Positional arguments matching the placeholders of build_sql(mode, ...)
+def query_params(query: ChatHistoryQuery, mode: str) -> tuple:
+    if mode == SEARCH_FTS:
+        params = (query.search_term, query.context_radius, headline_options(query.context_radius))
+    elif mode == SEARCH_PREFIX:
+        # Patterns are lowercased in SQL; escaping is not affected by case
+        params = (like_escape(query.search_term) + "%",)
+    elif mode == SEARCH_LONG_PREFIX:
+        # Cut before lowering to mirror lower(left(content, N)) in the column
+        params = (
+            like_escape(query.search_term[:CONTENT_LC_LENGTH]) + "%",
+            like_escape(query.search_term) + "%",
+        )
+    else:
+        params = (f"%{query.search_term}%",)
+    if query.author_role:
+        params += (query.author_role,)
+    if query.conversation_title:
+        params += (f"%{query.conversation_title}%",)
+    return params
+
+# Trim a long ILIKE or prefix match to context_radius characters centred on the search term.
+# lc_term is the lowercased search term; returns (content, truncated).
+def extract_snippet(content: str, lc_term: str, context_radius: int):
+    if len(content) <= context_radius:
+        return content, False
+
+    # Case-insensitive literal lookup; str.find is much cheaper than the regex engine.
+    # Only long contents get here, so the lower() copy is always needed. lower() can
+    # change the length (e.g. "İ" becomes two code points), and then its positions
+    # no longer line up with content, so the regex engine locates the match instead
+    lc_content = content.lower()
+    if len(lc_content) == len(content):
+        idx = lc_content.find(lc_term)
+        match_end = idx + len(lc_term)
+    else:
+        match = re.search(re.escape(lc_term), content, re.IGNORECASE)
+        idx = match.start() if match else -1
+        match_end = match.end() if match else -1
+    if idx >= 0:
+        start = max(0, idx - context_radius // 2)
+        end = min(len(content), match_end + context_radius // 2)
+        snippet = content[start:end]
+        if start > 0:
+            snippet = "..." + snippet
+        if end < len(content):
+            snippet = snippet + "..."
+        return snippet, True
+
+    return content[:context_radius] + "...", True
+
+# Build a ChatEntry-shaped dict from a result row. Rows come from our own SQL, so
+# skip Pydantic validation and hand the dict straight to orjson. Full-text rows
+# already carry their ts_headline snippet and truncated flag; where the headline
+# sits in the message is not known, so truncated ones are marked on both ends to
+# match extract_snippet's "..." markers
+def row_to_entry(row, query: ChatHistoryQuery, mode: str, lc_term: str) -> dict:
+    if mode == SEARCH_FTS:
+        content, truncated = row[3], row[4]
+        if truncated:
+            content = "..." + content + "..."
+    else:
+        content, truncated = extract_snippet(row[3], lc_term, query.context_radius)
+    return {
+        "timestamp": row[0],
+        "author": row[1],
+        "title": row[2],
+        "content": content,
+        "truncated": truncated
+    }
+
+# The SQL and positional arguments for running `query` in the given mode
+def search_statement(query: ChatHistoryQuery, mode: str):
+    sql = search_sql(
+        mode, bool(query.author_role), bool(query.conversation_title), clamp_limit(query.limit)
+    )
+    return sql, query_params(query, mode)
+
+# plainto_tsquery drops stopwords, so a phrase made only of them ("to be") has no
+# lexemes and can never match. Only asked after a full-text search found nothing
+async def has_lexemes(conn: asyncpg.Connection, search_term: str) -> bool:
+    return await conn.fetchval(
+        "SELECT numnode(plainto_tsquery('english', $1)) > 0", search_term
+    )
+
+# Run a search on a pooled connection and return ChatEntry-shaped dicts
+async def run_chat_query(pool: asyncpg.Pool, query: ChatHistoryQuery) -> List[dict]:
+    mode = search_mode(query)
+
+    async with pool.acquire() as conn:
+        sql, params = search_statement(query, mode)
+        rows = await conn.fetch(sql, *params)
+        # Stopword-only phrases fall back to the substring search
+        if not rows and mode == SEARCH_FTS and not await has_lexemes(conn, query.search_term):
+            mode = SEARCH_ILIKE
+            sql, params = search_statement(query, mode)
+            rows = await conn.fetch(sql, *params)
+
+    lc_term = query.search_term.lower()
+    return [row_to_entry(row, query, mode, lc_term) for row in rows]
+
+# Same search as run_chat_query, yielded one entry at a time from a server-side
+# cursor so only `prefetch` rows are held in memory
+async def stream_chat_query(
+    pool: asyncpg.Pool, query: ChatHistoryQuery, prefetch: int = 50
+) -> AsyncIterator[dict]:
+    mode = search_mode(query)
+    lc_term = query.search_term.lower()
+
+    async with pool.acquire() as conn:
+        # asyncpg cursors only live inside a transaction
+        async with conn.transaction():
+            found = False
+            sql, params = search_statement(query, mode)
+            async for row in conn.cursor(sql, *params, prefetch=prefetch):
+                found = True
+                yield row_to_entry(row, query, mode, lc_term)
+
+            # Stopword-only phrases fall back to the substring search
+            if not found and mode == SEARCH_FTS and not await has_lexemes(conn, query.search_term):
+                mode = SEARCH_ILIKE
+                sql, params = search_statement(query, mode)
+                async for row in conn.cursor(sql, *params, prefetch=prefetch):
+                    yield row_to_entry(row, query, mode, lc_term)
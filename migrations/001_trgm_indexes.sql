@@ -0,0 +1,10 @@
+-- Trigram indexes so the substring searches in query_chat_history
+-- (m.content ILIKE '%term%', c.title ILIKE '%title%') can use an index
+-- instead of scanning the whole table.
+CREATE EXTENSION IF NOT EXISTS pg_trgm;
+
+CREATE INDEX IF NOT EXISTS messages_content_trgm
+    ON messages USING gin (content gin_trgm_ops);
+
+CREATE INDEX IF NOT EXISTS conversations_title_trgm
+    ON conversations USING gin (title gin_trgm_ops);
@@ -0,0 +1,8 @@
+-- Full-text search column for multi-word queries in query_chat_history
+-- (m.content_tsv @@ plainto_tsquery('english', ...), ranked by ts_rank_cd).
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS content_tsv tsvector
+    GENERATED ALWAYS AS (to_tsvector('english', content)) STORED;
+
+CREATE INDEX IF NOT EXISTS messages_content_tsv
+    ON messages USING gin (content_tsv);
@@ -0,0 +1,10 @@
+-- Ordered indexes for "ORDER BY m.timestamp DESC LIMIT n" in query_chat_history,
+-- so broad searches can walk the newest messages and stop at the limit instead
+-- of sorting every match. The partial index mirrors the handler's
+-- m.author_role != 'tool' predicate; the composite one serves author_role filters.
+CREATE INDEX IF NOT EXISTS messages_ts_desc_idx
+    ON messages (timestamp DESC)
+    WHERE author_role != 'tool';
+
+CREATE INDEX IF NOT EXISTS messages_role_ts_idx
+    ON messages (author_role, timestamp DESC);
@@ -0,0 +1,10 @@
+-- Lowercased message prefix for "prefix": true searches in query_chat_history
+-- (m.content_lc LIKE lower('term%')), answered by a btree range scan. Only the first
+-- 255 characters are kept so every value fits in a btree index entry; this
+-- must match CONTENT_LC_LENGTH in chat_history_core.py.
+ALTER TABLE messages
+    ADD COLUMN IF NOT EXISTS content_lc text
+    GENERATED ALWAYS AS (lower(left(content, 255))) STORED;
+
+CREATE INDEX IF NOT EXISTS messages_content_lc_prefix
+    ON messages (content_lc text_pattern_ops);
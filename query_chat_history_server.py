@@ -1,33 +1,124 @@
 from fastapi import FastAPI, HTTPException, Depends
 from fastapi import Security
 from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from pydantic import BaseModel
-import psycopg2
+import asyncpg
+from contextlib import asynccontextmanager
 import os
-import re
+import asyncio
+import orjson
 from typing import Optional, List
-from datetime import datetime
-import traceback
-import requests
-from fastapi.responses import RedirectResponse, JSONResponse
+import atexit
+import logging
+import queue
+from logging.handlers import QueueHandler, QueueListener
+import httpx
+from cachetools import TTLCache
+from fastapi.responses import RedirectResponse, ORJSONResponse, StreamingResponse
 from dotenv import load_dotenv
+from chat_history_core import ChatHistoryQuery, ChatEntry, run_chat_query, stream_chat_query
 
 load_dotenv()
+
+# Records are queued and written to stderr by a background thread, so a burst of
+# errors (e.g. during a database outage) never blocks request handling on I/O.
+# The queue is bounded and records arriving while it is full are dropped.
+LOG_QUEUE_SIZE = 1000
+
+class DroppingQueueHandler(QueueHandler):
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            pass
+
+class DrainingQueueListener(QueueListener):
+    # The stop sentinel has to get in even when the queue is full; the listener
+    # thread is still draining it, so wait briefly for room
+    def enqueue_sentinel(self):
+        try:
+            self.queue.put(self._sentinel, timeout=1)
+        except queue.Full:
+            pass
+
+_log_queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+_log_handler = DroppingQueueHandler(_log_queue)
+_stderr_handler = logging.StreamHandler()
+_stderr_handler.setFormatter(logging.Formatter("%(levelname)s: %(name)s: %(message)s"))
+LOG_LISTENER = DrainingQueueListener(_log_queue, _stderr_handler)
+
+log = logging.getLogger(__name__)
+log.addHandler(_log_handler)
+log.propagate = False
+
+# uvicorn reports unhandled request errors (e.g. GitHub timeouts in validate_token)
+# on uvicorn.error; route those through the same queue instead of its stderr handler
+_uvicorn_error = logging.getLogger("uvicorn.error")
+_uvicorn_error.handlers = [_log_handler]
+_uvicorn_error.propagate = False
+
+# Started at import rather than in the lifespan so nothing is lost when the app
+# runs without one
+LOG_LISTENER.start()
+atexit.register(LOG_LISTENER.stop)
+
 GITHUB_CLIENT_ID = os.environ["GITHUB_CLIENT_ID"]
 GITHUB_CLIENT_SECRET = os.environ["GITHUB_CLIENT_SECRET"]
 
 REDIRECT_URI = "https://ashendoormcp-production.up.railway.app/auth/callback"
 DEV_REDIRECT_URI = "http://localhost:8000/auth/callback"
 
-app = FastAPI()
-
 # Load database connection info from environment variables
 DB_HOST = os.environ["DB_HOST"]
 DB_NAME = os.environ["DB_NAME"]
 DB_USER = os.environ["DB_USER"]
 DB_PASS = os.environ["DB_PASS"]
+DB_PORT = int(os.environ.get("DB_PORT", "5432"))
 AUTH_TOKEN = os.environ["AUTH_TOKEN"]
 
+# Rows fetched per round trip by the streaming endpoint's server-side cursor
+STREAM_PREFETCH = 50
+
+# Set when DB_HOST/DB_PORT point at PgBouncer in transaction pooling mode
+DB_PGBOUNCER = os.environ.get("DB_PGBOUNCER", "").lower() in ("1", "true", "yes")
+
+# Process-wide connection pool, created on startup and closed on shutdown
+POOL: Optional[asyncpg.Pool] = None
+
+# Shared GitHub clients; keep-alive (and HTTP/2) connections avoid a fresh
+# TCP + TLS handshake on every OAuth exchange and token check
+GH_CLIENT: Optional[httpx.AsyncClient] = None
+GH_API: Optional[httpx.AsyncClient] = None
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global POOL, GH_CLIENT, GH_API
+    if DB_PGBOUNCER:
+        # PgBouncer shares server connections across workers, so keep the local
+        # pool small and skip the prepared statement cache: a transaction-pooled
+        # server connection does not carry session state between transactions
+        pool_options = {"min_size": 1, "max_size": 5, "statement_cache_size": 0}
+    else:
+        pool_options = {"min_size": 5, "max_size": 20}
+    POOL = await asyncpg.create_pool(
+        host=DB_HOST,
+        port=DB_PORT,
+        database=DB_NAME,
+        user=DB_USER,
+        password=DB_PASS,
+        **pool_options
+    )
+    GH_CLIENT = httpx.AsyncClient(base_url="https://github.com", timeout=5.0, http2=True)
+    GH_API = httpx.AsyncClient(base_url="https://api.github.com", timeout=5.0, http2=True)
+    try:
+        yield
+    finally:
+        await GH_API.aclose()
+        await GH_CLIENT.aclose()
+        await POOL.close()
+        POOL = GH_CLIENT = GH_API = None
+
+app = FastAPI(lifespan=lifespan, default_response_class=ORJSONResponse)
+
 security = HTTPBearer(auto_error=True)
 
 @app.get("/login")
@@ -41,10 +132,10 @@ def login():
     return RedirectResponse(github_auth_url)
 
 @app.get("/auth/callback")
-def auth_callback(code: str):
+async def auth_callback(code: str):
     # Exchange the code for a token
-    token_response = requests.post(
-        "https://github.com/login/oauth/access_token",
+    token_response = await GH_CLIENT.post(
+        "/login/oauth/access_token",
         headers={"Accept": "application/json"},
         data={
             "client_id": GITHUB_CLIENT_ID,
@@ -55,47 +146,34 @@ def auth_callback(code: str):
     )
 
     if token_response.status_code != 200:
-        return JSONResponse(status_code=token_response.status_code, content={"error": "Token exchange failed"})
+        return ORJSONResponse(status_code=token_response.status_code, content={"error": "Token exchange failed"})
 
     token_json = token_response.json()
     access_token = token_json.get("access_token")
 
     if not access_token:
-        return JSONResponse(status_code=400, content={"error": "No access token received"})
+        return ORJSONResponse(status_code=400, content={"error": "No access token received"})
 
     # OpenAI expects access_token + token_type in response
-    return JSONResponse({
+    return ORJSONResponse({
         "access_token": access_token,
         "token_type": "bearer"
     })
 
-# Connect to the PostgreSQL database
-def get_db_connection():
-    return psycopg2.connect(
-        host=DB_HOST,
-        dbname=DB_NAME,
-        user=DB_USER,
-        password=DB_PASS
-    )
+# GitHub logins of recently validated tokens, so only the first request in each
+# TTL window pays for the round trip to api.github.com
+GITHUB_TOKEN_CACHE = TTLCache(maxsize=1024, ttl=300)
+
+# Tokens GitHub recently rejected, so repeating a bad token does not cost another
+# round trip (or another early search, see query_chat_history)
+GITHUB_REJECTED_CACHE = TTLCache(maxsize=1024, ttl=60)
 
-# Input schema for MCP search
-class ChatHistoryQuery(BaseModel):
-    search_term: str
-    author_role: Optional[str] = None
-    conversation_title: Optional[str] = None
-    limit: Optional[int] = 10
-    context_radius: Optional[int] = 2500
-
-# Output schema
-class ChatEntry(BaseModel):
-    timestamp: datetime
-    author: str
-    title: Optional[str]
-    content: str
-    truncated: Optional[bool] = False
+# At most this many searches may start before their GitHub check has finished, so
+# unverified tokens cannot tie up the connection pool
+EARLY_SEARCHES = asyncio.Semaphore(2)
 
 # Validate bearer token
-def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
+async def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)):
     token = credentials.credentials
 
     # Allow legacy static token (fallback only)
@@ -104,16 +182,26 @@ def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)
 
     # Check if GitHub-style token
     if token.startswith("gho_"):
-        user_info = requests.get(
-            "https://api.github.com/user",
-            headers={"Authorization": f"Bearer {token}"}
-        )
-
-        if user_info.status_code != 200:
+        if token in GITHUB_REJECTED_CACHE:
             raise HTTPException(status_code=401, detail="Invalid GitHub token")
 
-        user = user_info.json()
-        github_login = user.get("login")
+        github_login = GITHUB_TOKEN_CACHE.get(token)
+        if github_login is None:
+            user_info = await GH_API.get(
+                "/user",
+                headers={"Authorization": f"Bearer {token}"}
+            )
+
+            if user_info.status_code != 200:
+                # Only remember definite rejections, not GitHub outages or rate limits
+                if user_info.status_code == 401:
+                    GITHUB_REJECTED_CACHE[token] = True
+                raise HTTPException(status_code=401, detail="Invalid GitHub token")
+
+            user = user_info.json()
+            github_login = user.get("login")
+            if github_login:
+                GITHUB_TOKEN_CACHE[token] = github_login
 
         # Optionally restrict access to yourself only
         if github_login != "VBWizard":
@@ -123,86 +211,89 @@ def validate_token(credentials: HTTPAuthorizationCredentials = Depends(security)
 
     raise HTTPException(status_code=401, detail="Unauthorized token format")
 
-@app.post("/query_chat_history", response_model=List[ChatEntry])
-def query_chat_history(
+# True when validate_token will have to ask GitHub about this token
+def needs_github_check(token: str) -> bool:
+    return (
+        token.startswith("gho_")
+        and token not in GITHUB_TOKEN_CACHE
+        and token not in GITHUB_REJECTED_CACHE
+    )
+
+# Run the search, logging failures and surfacing them as a 500
+async def run_search(query: ChatHistoryQuery):
+    try:
+        return await run_chat_query(POOL, query)
+    except Exception as e:
+        log.exception("query_chat_history failed")
+        raise HTTPException(status_code=500, detail=str(e))
+
+# Rows are returned as an ORJSONResponse so neither response_model validation nor
+# jsonable_encoder touches them; orjson encodes the dicts (datetimes included)
+# directly. The schema is still documented through responses
+@app.post("/query_chat_history", response_model=None, responses={200: {"model": List[ChatEntry]}})
+async def query_chat_history(
     query: ChatHistoryQuery,
     credentials: HTTPAuthorizationCredentials = Security(security)
 ):
-    user = validate_token(credentials)  # Optionally return GitHub user info
-    conn = get_db_connection()
-    cur = conn.cursor()
-
-    params = []
-    conditions = ["m.content ILIKE %s", "m.author_role != 'tool'"]
-    params.append(f"%{query.search_term}%")
-
-    if query.author_role:
-        conditions.append("m.author_role = %s")
-        params.append(query.author_role)
+    # Only search ahead of an unfinished GitHub check when an early-search slot and
+    # an idle pooled connection are both free; otherwise authenticate first
+    if (
+        not needs_github_check(credentials.credentials)
+        or EARLY_SEARCHES.locked()
+        or POOL.get_idle_size() == 0
+    ):
+        user = await validate_token(credentials)  # Optionally return GitHub user info
+        return ORJSONResponse(await run_search(query))
 
-    if query.conversation_title:
-        conditions.append("c.title ILIKE %s")
-        params.append(f"%{query.conversation_title}%")
+    # The GitHub token check and the search are independent round trips, so run
+    # them concurrently. No rows are returned unless the token checks out, and a
+    # failed check cancels the query.
+    async with EARLY_SEARCHES:
+        auth_task = asyncio.create_task(validate_token(credentials))
+        db_task = asyncio.create_task(run_search(query))
+        try:
+            user = await auth_task
+        except BaseException:
+            db_task.cancel()
+            # Wait for the connection to go back to the pool and drop the query's outcome
+            await asyncio.gather(db_task, return_exceptions=True)
+            raise
+        rows = await db_task
+    return ORJSONResponse(rows)
 
-    sql = f"""
-        SELECT m.timestamp, m.author_role, c.title, m.content
-        FROM messages m
-        JOIN conversations c ON m.conversation_id = c.id
-        WHERE {' AND '.join(conditions)}
-        ORDER BY m.timestamp DESC
-        LIMIT %s
-    """
-
-    params.append(query.limit)
+@app.post("/query_chat_history/stream", response_model=None)
+async def query_chat_history_stream(
+    query: ChatHistoryQuery,
+    credentials: HTTPAuthorizationCredentials = Security(security)
+):
+    # Same search as /query_chat_history, streamed as NDJSON (one entry per line)
+    await validate_token(credentials)
 
+    # Run the query and fetch the first row before the 200 header goes out, so a
+    # failing query still gets the same 500 as /query_chat_history. The stream keeps
+    # its connection until entries() closes it.
+    rows = stream_chat_query(POOL, query, prefetch=STREAM_PREFETCH)
     try:
-        cur.execute(sql, params)
-        rows = cur.fetchall()
+        first = await anext(rows)
+    except StopAsyncIteration:
+        first = None
     except Exception as e:
-        traceback.print_exc()
+        log.exception("query_chat_history failed")
         raise HTTPException(status_code=500, detail=str(e))
-    finally:
-        cur.close()
-        conn.close()
-
-    results = []
-    for row in rows:
-        content = row[3]
-        if len(content) <= query.context_radius:
-            results.append(ChatEntry(
-                timestamp=row[0],
-                author=row[1],
-                title=row[2],
-                content=content,
-                truncated=False
-            ))
-        else:
-            match = re.search(re.escape(query.search_term), content, re.IGNORECASE)
-            if match:
-                start = max(0, match.start() - query.context_radius // 2)
-                end = min(len(content), match.end() + query.context_radius // 2)
-                snippet = content[start:end]
-                if start > 0:
-                    snippet = "..." + snippet
-                if end < len(content):
-                    snippet = snippet + "..."
-                results.append(ChatEntry(
-                    timestamp=row[0],
-                    author=row[1],
-                    title=row[2],
-                    content=snippet,
-                    truncated=True
-                ))
-            else:
-                snippet = content[:query.context_radius]
-                if len(content) > query.context_radius:
-                    snippet += "..."
-                results.append(ChatEntry(
-                    timestamp=row[0],
-                    author=row[1],
-                    title=row[2],
-                    content=snippet,
-                    truncated=True
-                ))
-
-    return results
+
+    async def entries():
+        try:
+            if first is None:
+                return
+            yield orjson.dumps(first) + b"\n"
+            async for entry in rows:
+                yield orjson.dumps(entry) + b"\n"
+        except Exception:
+            # The 200 is already out. Re-raise so the server aborts the unfinished
+            # chunked body and the client sees the failure instead of a short result
+            log.exception("query_chat_history stream failed")
+            raise
+        finally:
+            await rows.aclose()
+
+    return StreamingResponse(entries(), media_type="application/x-ndjson")